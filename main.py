@@ -1,62 +1,164 @@
 import math
+import multiprocessing
+import os
+import numpy as np
 import pygame
-import random
 import json
-from itertools import count
-from collections import namedtuple
+from multiprocessing import shared_memory
 
-Point = namedtuple('Point', 'x y')
+try:
+    import numba
+    from numba import cuda, njit, prange
+except ImportError:
+    njit = None
 
 
 # Global config
 WIN_SIZE = [600, 800]
+GENOME_SIZE = 300
 
+# The genes turn the rockets in whole degrees, so the angles are kept as
+# integers that index these lookup tables.
+_COS = np.cos(np.radians(np.arange(360))).astype(np.float32)
+_SIN = np.sin(np.radians(np.arange(360))).astype(np.float32)
 
-# ------------------------------------------------------------------------------
-class Rocket:
-    _id = count(0)
-
-    def __init__(self):
-        self.genome = [random.randint(-7, 7) for _ in range(300)]
-        self.fitness = -1
-        self.id = next(self._id)
-        self.alive = True
-
-        self.angle = 0
-        self.pos = Point(0, 0)
-
-    def __repr__(self):
-        items = ("%s: %r" % (k, v) for k, v in self.__dict__.items())
-        return "<%s: {%s}>" % (self.__class__.__name__, ', '.join(sorted(items)))
-
-    def draw(self, surface):
-        border = [(0, 0), (-10, 10), (10, 0), (-10, -10)]
-        translated = self._translate(border, self.pos)
-        rotated = [self._rotate_point(self.pos, p, self.angle) for p in translated]
-        border_color = (255, 255, 9) if self.alive else (255, 0, 0)
-        pygame.draw.polygon(surface, border_color, rotated, 0)
-
-    def apply_force(self, force):
-        radians = math.radians(self.angle)
-        x = self.pos.x + math.cos(radians) * force
-        y = self.pos.y + math.sin(radians) * force
-        self.pos = Point(x, y)
 
-    def _translate(self, border, position):
-        result = []
-        for p in border:
-            result.append([sum(x) for x in zip(p, position)])
-        return result
-
-    def _rotate_point(self, origin, point, angle):
-        ox, oy = origin
-        px, py = point
-        radians = math.radians(angle)
-
-        qx = ox + math.cos(radians) * (px - ox) - math.sin(radians) * (py - oy)
-        qy = oy + math.sin(radians) * (px - ox) + math.cos(radians) * (py - oy)
-
-        return qx, qy
+# ------------------------------------------------------------------------------
+def _step_numpy(pos_x, pos_y, angle, alive, genome, obst, index, width, height):
+    """Moves all alive rockets one frame and kills the ones that collide."""
+    genes = genome[alive, index % genome.shape[1]]
+    turned = (angle[alive] + genes) % 360
+    angle[alive] = turned
+    pos_x[alive] += _COS[turned] * 3
+    pos_y[alive] += _SIN[turned] * 3
+
+    x, y = pos_x, pos_y
+    # Check if the rocket flies over any edge.
+    outside = (x < 0) | (x > width) | (y < 0) | (y > height)
+    # Check if the rocket flies into a obstacle, same bounds as Rect.collidepoint.
+    x, y = x[:, None], y[:, None]
+    hit = ((x >= obst[:, 0]) & (x < obst[:, 2]) &
+           (y >= obst[:, 1]) & (y < obst[:, 3])).any(axis=1)
+    alive &= ~(outside | hit)
+
+
+if njit is not None:
+    @njit(fastmath=True, parallel=True, cache=True)
+    def _step(pos_x, pos_y, angle, alive, genome, obst, index, width, height):
+        """Moves all alive rockets one frame and kills the ones that collide."""
+        for i in prange(pos_x.shape[0]):
+            if not alive[i]:
+                continue
+            angle[i] = (angle[i] + genome[i, index % genome.shape[1]]) % 360
+            pos_x[i] += _COS[angle[i]] * 3
+            pos_y[i] += _SIN[angle[i]] * 3
+            x, y = pos_x[i], pos_y[i]
+            if x < 0 or x > width or y < 0 or y > height:
+                alive[i] = False
+                continue
+            for j in range(obst.shape[0]):
+                if obst[j, 0] <= x < obst[j, 2] and obst[j, 1] <= y < obst[j, 3]:
+                    alive[i] = False
+                    break
+
+    @njit(cache=True)
+    def _top_k(fitness, k):
+        """Returns the indices of the k fittest rockets, in no particular order."""
+        best_idx = np.empty(k, dtype=np.int64)
+        best_val = np.empty(k, dtype=fitness.dtype)
+        worst = 0
+        for i in range(fitness.shape[0]):
+            if i < k:
+                best_idx[i] = i
+                best_val[i] = fitness[i]
+                if best_val[i] < best_val[worst]:
+                    worst = i
+            elif fitness[i] > best_val[worst]:
+                best_idx[worst] = i
+                best_val[worst] = fitness[i]
+                for j in range(k):
+                    if best_val[j] < best_val[worst]:
+                        worst = j
+        return best_idx
+else:
+    _step = _step_numpy
+    _top_k = None
+
+
+def _init_worker():
+    # The workers already run in parallel, don't let each of them spawn a
+    # full set of numba threads as well.
+    if njit is not None:
+        numba.set_num_threads(1)
+
+
+def _simulate(args):
+    """Flies a slice of the population in shared memory through a whole generation.
+
+    Returns the final positions and angles of the rockets in the slice, and
+    which of them reached the goal.
+    """
+    shm_name, shape, lo, hi, start, goal, obst, width, height = args
+    goal_x, goal_y = goal
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        genome = np.ndarray(shape, dtype=np.int8, buffer=shm.buf)[lo:hi]
+        size = hi - lo
+        start_x, start_y = start
+        pos_x = np.full(size, start_x, dtype=np.float32)
+        pos_y = np.full(size, start_y + 3 - 50, dtype=np.float32)
+        angle = np.full(size, 270, dtype=np.int32)
+        alive = np.ones(size, dtype=bool)
+        reached = np.zeros(size, dtype=bool)
+        for index in range(genome.shape[1]):
+            _step(pos_x, pos_y, angle, alive, genome, obst, index, width, height)
+            # Stop the rockets that reach the goal, the rest keep flying.
+            dx, dy = pos_x - goal_x, pos_y - goal_y
+            arrived = alive & (dx * dx + dy * dy < 10 * 10)
+            reached |= arrived
+            alive &= ~arrived
+            if not alive.any():
+                break
+        del genome
+    finally:
+        shm.close()
+    return pos_x, pos_y, angle, reached
+
+
+if njit is not None and cuda.is_available():
+    @cuda.jit
+    def _simulate_kernel(genome, obst, start_x, start_y, goal_x, goal_y,
+                         width, height, pos_x, pos_y, angle, reached):
+        """Flies one rocket per thread through a whole generation."""
+        i = cuda.grid(1)
+        if i >= genome.shape[0]:
+            return
+        x = start_x
+        y = start_y + 3 - 50
+        a = 270
+        arrived = False
+        for index in range(genome.shape[1]):
+            a = (a + int(genome[i, index])) % 360
+            x += _COS[a] * 3
+            y += _SIN[a] * 3
+            if x < 0 or x > width or y < 0 or y > height:
+                break
+            hit = False
+            for j in range(obst.shape[0]):
+                if obst[j, 0] <= x < obst[j, 2] and obst[j, 1] <= y < obst[j, 3]:
+                    hit = True
+                    break
+            if hit:
+                break
+            if (x - goal_x) ** 2 + (y - goal_y) ** 2 < 10 * 10:
+                arrived = True
+                break
+        pos_x[i] = x
+        pos_y[i] = y
+        angle[i] = a
+        reached[i] = arrived
+else:
+    _simulate_kernel = None
 
 
 # ------------------------------------------------------------------------------
@@ -64,91 +166,158 @@ class Simulation:
     def __init__(self, win_size):
         self.win_size = pygame.Rect((0, 0), win_size)
         self.info_font = pygame.font.SysFont("comicsansms", 25)
+        self._sprites = self._make_sprites((255, 255, 9))
+        self._dead_sprites = self._make_sprites((255, 0, 0))
+        self.rng = np.random.default_rng()
+        self._cnf = None
+        self._cnf_cache = (None, None)
         self.restart()
 
     def restart(self):
-        self.rockets = []
         self.index = 0
 
-        self.obstacles = []
         self.generation = 1
         self.best_fitness = 0
+        self.current_fitness = 0
         self.fps = 30
+        self.steps_per_render = 1
 
         # from config file
         cnf = self._load_config()
         self.population = int(cnf['population'])
-        for obst in cnf['obstacles']:
-            self.obstacles.append(pygame.Rect(obst))
-        self.start = Point(int(cnf['start_pos'][0]), int(cnf['start_pos'][1]))
-        self.goal = Point(int(cnf['goal'][0]), int(cnf['goal'][1]))
-
-        self.rockets = [Rocket() for _ in range(self.population)]
-        self.rockets = self._reset_rockets(self.rockets)
+        if cnf is not self._cnf:
+            # The obstacles only have to be rebuilt when the config changed.
+            self._cnf = cnf
+            self.obstacles = [pygame.Rect(obst) for obst in cnf['obstacles']]
+            # The Rects are only used for drawing, the physics use the bounds.
+            bounds = np.array(cnf['obstacles'], dtype=np.float32).reshape(-1, 4)
+            bounds[:, 2:] += bounds[:, :2]  # x, y, w, h -> x0, y0, x1, y1
+            self._obstacle_bounds = bounds
+            if _simulate_kernel is not None:
+                self._device_obstacles = cuda.to_device(self._obstacle_bounds)
+        self.start = (int(cnf['start_pos'][0]), int(cnf['start_pos'][1]))
+        self.goal = (int(cnf['goal'][0]), int(cnf['goal'][1]))
+        self._total_distance = self._distance(self.start, self.goal)
+
+        # The rockets are stored as a structure of arrays, one row per rocket.
+        self.genome = self._random_genes((self.population, GENOME_SIZE))
+        self._reset_rockets()
 
     def update(self):
-        for rocket in self.rockets:
-            if rocket.alive:
-                rocket.apply_force(3)
-                rocket.angle += rocket.genome[self.index % len(rocket.genome)]
+        _step(self.pos_x, self.pos_y, self.angle, self.alive, self.genome,
+              self._obstacle_bounds, self.index,
+              self.win_size.width, self.win_size.height)
+        self._alive_count = int(np.count_nonzero(self.alive))
         self.index += 1
-        self._check_collision()
-        self.rockets = self._fitness(self.rockets)
+        self._fitness()
+
+    def run_generation(self, pool, chunks):
+        """Flies the whole generation at once, split over the workers in the pool.
+
+        Rockets still flying when their genome runs out are stopped, so the
+        generation is over when this returns. Only the rockets that reached
+        the goal are left alive, like in update(). Runs on the GPU instead when
+        numba finds a CUDA device.
+        """
+        if _simulate_kernel is not None:
+            self._run_generation_cuda()
+            return
+        shm = shared_memory.SharedMemory(create=True, size=self.genome.nbytes)
+        try:
+            genome = np.ndarray(self.genome.shape, dtype=np.int8, buffer=shm.buf)
+            genome[:] = self.genome
+            del genome
+            bounds = np.linspace(0, len(self.genome), chunks + 1, dtype=int)
+            results = pool.map(_simulate, [
+                (shm.name, self.genome.shape, lo, hi, self.start, self.goal,
+                 self._obstacle_bounds, self.win_size.width, self.win_size.height)
+                for lo, hi in zip(bounds[:-1], bounds[1:]) if lo < hi])
+        finally:
+            shm.close()
+            shm.unlink()
+        pos_x, pos_y, angle, reached = zip(*results)
+        self.pos_x = np.concatenate(pos_x)
+        self.pos_y = np.concatenate(pos_y)
+        self.angle = np.concatenate(angle)
+        self.alive = np.concatenate(reached)
+        self._alive_count = int(np.count_nonzero(self.alive))
+        self.index = self.genome.shape[1]
+        self._fitness()
+
+    def _run_generation_cuda(self):
+        size = len(self.genome)
+        pos_x = cuda.device_array(size, dtype=np.float32)
+        pos_y = cuda.device_array(size, dtype=np.float32)
+        angle = cuda.device_array(size, dtype=np.int32)
+        reached = cuda.device_array(size, dtype=np.bool_)
+        (start_x, start_y), (goal_x, goal_y) = self.start, self.goal
+        threads = 128
+        _simulate_kernel[(size + threads - 1) // threads, threads](
+            cuda.to_device(self.genome), self._device_obstacles,
+            float(start_x), float(start_y), float(goal_x), float(goal_y),
+            self.win_size.width, self.win_size.height,
+            pos_x, pos_y, angle, reached)
+        self.pos_x = pos_x.copy_to_host()
+        self.pos_y = pos_y.copy_to_host()
+        self.angle = angle.copy_to_host()
+        self.alive = reached.copy_to_host()
+        self._alive_count = int(np.count_nonzero(self.alive))
+        self.index = self.genome.shape[1]
+        self._fitness()
 
     def draw(self, surface):
         surface.fill((0, 0, 0))
         self._draw_start_platform(surface)
         self._draw_goal(surface)
-        for rocket in self.rockets:
-            rocket.draw(surface)
+        rockets = zip(self.pos_x.tolist(), self.pos_y.tolist(),
+                      self.angle.tolist(), self.alive.tolist())
+        blits = []
+        for x, y, angle, alive in rockets:
+            sprite, (w, h) = (self._sprites if alive else self._dead_sprites)[angle]
+            blits.append((sprite, (x - w / 2, y - h / 2)))
+        surface.blits(blits, doreturn=False)
         self._draw_overlay(surface)
         self._draw_obstacles(surface)
 
         pygame.display.flip()
 
     def next_gen(self):
-        rockets = self._selection(self.rockets)
-        rockets = self._crossover(rockets)
-        rockets = self._mutation(rockets)
-        rockets = self._reset_rockets(rockets)
-        self.rockets.clear()
-        self.rockets = rockets
+        genome = self._selection()
+        genome = self._crossover(genome)
+        genome = self._mutation(genome)
+        self.genome = genome
+        self._reset_rockets()
         self.index = 0
         self.generation += 1
 
     def alive_rockets(self):
-        return sum(1 for r in self.rockets if r.alive)
+        return self._alive_count
 
     def found_solution(self):
-        return any([r for r in self.rockets if self._distance(r.pos, self.goal) < 10])
-
-    def _reset_rockets(self, rockets):
-        for rocket in rockets:
-            rocket.pos = Point(self.start.x, self.start.y + 3 - 50)
-            rocket.angle = 270
-            rocket.alive = True
-        return rockets
-
-    def _check_collision(self):
-        for rocket in self.rockets:
-            # Check if the rocket flies over any edge.
-            if rocket.pos.x < 0 or rocket.pos.x > self.win_size.width:
-                rocket.alive = False
-            elif rocket.pos.y < 0 or rocket.pos.y > self.win_size.height:
-                rocket.alive = False
-            # Check if the rocket flies into a obstacle.
-            for obs in self.obstacles:
-                    if obs.collidepoint(rocket.pos):
-                        rocket.alive = False
+        goal_x, goal_y = self.goal
+        dx = self.pos_x - goal_x
+        dy = self.pos_y - goal_y
+        return bool((dx * dx + dy * dy < 10 * 10).any())
+
+    def set_goal(self, goal):
+        self.goal = goal
+        self._total_distance = self._distance(self.start, self.goal)
+
+    def _reset_rockets(self):
+        size = len(self.genome)
+        start_x, start_y = self.start
+        self.pos_x = np.full(size, start_x, dtype=np.float32)
+        self.pos_y = np.full(size, start_y + 3 - 50, dtype=np.float32)
+        self.angle = np.full(size, 270, dtype=np.int32)
+        self.alive = np.ones(size, dtype=bool)
+        self._alive_count = size
+        self.fitness = np.full(size, -1, dtype=np.float32)
 
     def _draw_overlay(self, surface):
-        best_fitness = round(max(self.rockets, key=lambda x: x.fitness).fitness)
-        self.best_fitness = max(self.best_fitness, best_fitness)
-
         labels = [
             "Generation: " + str(self.generation),
-            "FPS: " + str(self.fps),
-            "Best fitness: " + str(best_fitness) + '/' + str(self.best_fitness),
+            "FPS: " + str(self.fps) + ' x' + str(self.steps_per_render),
+            "Best fitness: " + str(self.current_fitness) + '/' + str(self.best_fitness),
             "Alive: " + str(self.alive_rockets())]
         y_pos = 10
         for label in labels:
@@ -156,10 +325,23 @@ class Simulation:
                 label, 2, (255, 255, 255)), (10, y_pos))
             y_pos += 30
 
+    def _make_sprites(self, color):
+        """Prerenders a rocket pointing at each whole degree, with its size."""
+        base = pygame.Surface((21, 21), pygame.SRCALPHA)
+        # The rocket's position is at the center of the surface.
+        border = [(10, 10), (0, 20), (20, 10), (0, 0)]
+        pygame.draw.polygon(base, color, border, 0)
+        sprites = []
+        for angle in range(360):
+            # The y axis points down, so a positive angle turns clockwise.
+            sprite = pygame.transform.rotate(base, -angle)
+            sprites.append((sprite, sprite.get_size()))
+        return sprites
+
     def _draw_start_platform(self, surface):
-        x0 = self.start.x - 20
+        start_x, y = self.start
+        x0 = start_x - 20
         x1 = x0 + 40
-        y = self.start.y
         pygame.draw.line(surface, (0, 0, 255), [x0, y], [x1, y], 6)
 
     def _draw_goal(self, surface):
@@ -169,62 +351,66 @@ class Simulation:
         for obs in self.obstacles:
             pygame.draw.rect(surface, (255, 102, 0), obs)
 
-    def _fitness(self, rockets):
-        total_distance = self._distance(self.start, self.goal)
-        for rocket in rockets:
-            d = self._distance(rocket.pos, self.goal)
-            rocket.fitness = 100 - (d / total_distance) * 100
-        return rockets
-
-    def _selection(self, rockets):
-        rockets = sorted(rockets, key=lambda r: r.fitness, reverse=True)
-        result = rockets[:int(0.2 * len(rockets))]
-        if random.uniform(0.0, 1.0) <= 0.1:
-            print('Selection(): Adding the two least fittest rockets.')
-            rockets.extend(rockets[-2:])
-        return result
-
-    def _crossover(self, rockets):
-        offspring = []
-        for _ in range(int((self.population - len(rockets)) / 2)):
-            parent1 = random.choice(rockets)
-            parent2 = random.choice([r for r in rockets if r != parent1])
-            child1 = Rocket()
-            child2 = Rocket()
-            split = random.randint(0, len(parent1.genome))
-            child1.genome = parent1.genome[0:split] + parent2.genome[split:]
-            child2.genome = parent2.genome[0:split] + parent1.genome[split:]
-
-            offspring.append(child1)
-            offspring.append(child2)
-
-        rockets.extend(offspring)
-        return rockets
-
-    def _mutation(self, rockets):
-        for rocket in rockets:
-            for i, _ in enumerate(rocket.genome):
-                if random.uniform(0.0, 1.0) <= 0.1:
-                    rocket.genome[i] = random.randint(-7, 7)
-        return rockets
+    def _fitness(self):
+        goal_x, goal_y = self.goal
+        np.hypot(self.pos_x - goal_x, self.pos_y - goal_y, out=self.fitness)
+        self.fitness *= -100 / self._total_distance
+        self.fitness += 100
+        # Tracked here rather than when drawing, since not every step is drawn.
+        self.current_fitness = round(float(self.fitness.max()))
+        self.best_fitness = max(self.best_fitness, self.current_fitness)
+
+    def _selection(self):
+        k = int(0.2 * len(self.genome))
+        if _top_k is not None and 0 < k < 16:
+            # Few survivors, keep them in a single pass over the population.
+            return self.genome[_top_k(self.fitness, k)]
+        return self.genome[np.argpartition(self.fitness, -k)[-k:]]
+
+    def _crossover(self, genome):
+        survivors = len(genome)
+        pairs = int((self.population - survivors) / 2)
+        parent1 = self.rng.integers(0, survivors, pairs)
+        # Offset the second parent so that it always differs from the first one.
+        parent2 = (parent1 + self.rng.integers(1, max(survivors, 2), pairs)) % survivors
+        splits = self.rng.integers(0, genome.shape[1] + 1, pairs)
+        mask = np.arange(genome.shape[1]) < splits[:, None]
+        child1 = np.where(mask, genome[parent1], genome[parent2])
+        child2 = np.where(mask, genome[parent2], genome[parent1])
+        return np.concatenate((genome, child1, child2))
+
+    def _mutation(self, genome):
+        mask = self.rng.random(genome.shape) < 0.1
+        genome[mask] = self._random_genes(np.count_nonzero(mask))
+        return genome
+
+    def _random_genes(self, size):
+        return self.rng.integers(-7, 8, size=size, dtype=np.int8)
 
     def _load_config(self):
-        cnf = {}
-        with open('config.json', 'r') as json_file:
-            cnf = json.load(json_file)
+        """Returns the parsed config file, only reading it again once it has changed."""
+        mtime = os.stat('config.json').st_mtime_ns
+        cached_mtime, cnf = self._cnf_cache
+        if mtime != cached_mtime:
+            with open('config.json', 'r') as json_file:
+                cnf = json.load(json_file)
+            self._cnf_cache = (mtime, cnf)
         return cnf
 
     def _distance(self, p1, p2):
-        return math.hypot(p1.x - p2.x, p1.y - p2.y)
+        return math.dist(p1, p2)
 
 
 # ------------------------------------------------------------------------------
 def main():
+    chunks = multiprocessing.cpu_count()
+    pool = None
     pygame.init()
     sim = Simulation(WIN_SIZE)
     surface = pygame.display.set_mode(WIN_SIZE)
     pygame.display.set_caption('smart rockets')
     done = False
+    headless = False
     clock = pygame.time.Clock()
 
     while not done:
@@ -242,15 +428,34 @@ def main():
                     sim.fps -= 5
                 elif event.key == pygame.K_r:
                     sim.restart()
+                elif event.key == pygame.K_h:
+                    headless = not headless
+                    if headless and pool is None and _simulate_kernel is None:
+                        # Spawn the workers, forking now would copy the display
+                        # and any numba threads already running.
+                        context = multiprocessing.get_context('spawn')
+                        pool = context.Pool(chunks, initializer=_init_worker)
+                elif event.key == pygame.K_t:
+                    sim.steps_per_render = 10 if sim.steps_per_render == 1 else 1
             elif event.type == pygame.MOUSEBUTTONUP:
                 if event.button == 3:  # Right mouse button
-                    x, y = pygame.mouse.get_pos()
-                    sim.goal = Point(x, y)
-        if sim.alive_rockets() == 0:
-            sim.next_gen()
-        if not sim.found_solution():
-            sim.update()
+                    sim.set_goal(pygame.mouse.get_pos())
+        steps = 0
+        for _ in range(1 if headless else sim.steps_per_render):
+            if sim.alive_rockets() == 0:
+                sim.next_gen()
+            if sim.found_solution():
+                break
+            if headless:
+                sim.run_generation(pool, chunks)
+            else:
+                sim.update()
+            steps += 1
+        if steps:
             sim.draw(surface)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':